@@ -1,18 +1,32 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+import asyncio
+import hashlib
+import heapq
 import json
 import os
-from typing import Dict, List, Optional
+import re
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import aiofiles
 import fitz  # PyMuPDF
+import orjson
+import zstandard as zstd
 from dotenv import load_dotenv
 import random
 import time
+import uuid
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Workflow Builder API", version="1.0.0")
+app = FastAPI(title="Workflow Builder API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # ✅ Enable CORS for local and deployed frontend
 app.add_middleware(
@@ -27,10 +41,241 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage
-documents_store = {}
-embeddings_store = {}
-workflows_store = {}
+def encode_field(value) -> bytes:
+    """Encode a record field for Redis: arrays and bytes stay raw, everything else is JSON."""
+    if isinstance(value, np.ndarray):
+        header = orjson.dumps({"dtype": value.dtype.str, "shape": value.shape})
+        return b"a" + header + b"\n" + value.tobytes()
+    if isinstance(value, bytes):
+        return b"b" + value
+    return b"j" + orjson.dumps(value)
+
+def decode_field(raw: bytes):
+    kind, body = raw[:1], raw[1:]
+    if kind == b"a":
+        header, _, data = body.partition(b"\n")
+        header = orjson.loads(header)
+        return np.frombuffer(data, dtype=header["dtype"]).reshape(header["shape"])
+    if kind == b"b":
+        return body
+    return orjson.loads(body)
+
+class MemoryStore:
+    """Process-local store of records that expire after a TTL.
+
+    A record can carry named maps (e.g. a word index) that share its expiry and are
+    read a few entries at a time with get_map_values.
+
+    Every record gets the same TTL, so insertion order is expiry order: expired records
+    are always at the front, and purging only ever touches those.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, record, maps), oldest first
+
+    def _purge(self):
+        now = time.monotonic()
+        while self.data:
+            expires_at, _, _ = next(iter(self.data.values()))
+            if expires_at > now:
+                break
+            self.data.popitem(last=False)
+
+    def _live_entry(self, key: str):
+        entry = self.data.get(key)
+        return entry if entry is not None and entry[0] > time.monotonic() else None
+
+    async def get(self, key: str, fields: Optional[List[str]] = None) -> Optional[dict]:
+        entry = self._live_entry(key)
+        if entry is None:
+            return None
+        record = entry[1]
+        return {field: record[field] for field in fields} if fields else record
+
+    async def get_map_values(self, key: str, map_name: str, map_keys: List[str]) -> list:
+        entry = self._live_entry(key)
+        values = entry[2].get(map_name, {}) if entry else {}
+        return [values.get(map_key) for map_key in map_keys]
+
+    async def get_many(self, keys: List[str], fields: Optional[List[str]] = None) -> List[Optional[dict]]:
+        return [await self.get(key, fields) for key in keys]
+
+    async def set(self, key: str, record: dict, maps: Optional[Dict[str, dict]] = None):
+        self._purge()
+        self.data.pop(key, None)
+        self.data[key] = (time.monotonic() + self.ttl, record, maps or {})
+
+    async def keys(self) -> List[str]:
+        """Keys of live records, oldest first."""
+        self._purge()
+        return list(self.data)
+
+class RedisStore:
+    """Store of records as Redis hashes, shared by all workers; records expire after a TTL.
+
+    Each field is stored separately, so callers can read only the fields they need. Named maps
+    are separate hashes, so a lookup fetches only the entries asked for. A sorted set of keys
+    by write time lists records (and finds the newest) without scanning the keyspace.
+    """
+
+    def __init__(self, redis, name: str, ttl: int):
+        self.redis = redis
+        self.name = name
+        self.ttl = ttl
+        # Records live under "{name}:", so this can never collide with a record key
+        self.index_key = f"{name}-index"
+
+    def _key(self, key: str) -> str:
+        return f"{self.name}:{key}"
+
+    def _map_key(self, map_name: str, key: str) -> str:
+        return f"{self.name}-{map_name}:{key}"
+
+    async def get(self, key: str, fields: Optional[List[str]] = None) -> Optional[dict]:
+        return (await self.get_many([key], fields))[0]
+
+    async def get_many(self, keys: List[str], fields: Optional[List[str]] = None) -> List[Optional[dict]]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                if fields:
+                    pipe.hmget(self._key(key), fields)
+                else:
+                    pipe.hgetall(self._key(key))
+            results = await pipe.execute()
+
+        if fields:
+            return [
+                None if None in values else {field: decode_field(value) for field, value in zip(fields, values)}
+                for values in results
+            ]
+        return [{field.decode(): decode_field(value) for field, value in raw.items()} or None for raw in results]
+
+    async def get_map_values(self, key: str, map_name: str, map_keys: List[str]) -> list:
+        if not map_keys:
+            return []
+        values = await self.redis.hmget(self._map_key(map_name, key), map_keys)
+        return [decode_field(value) if value is not None else None for value in values]
+
+    async def set(self, key: str, record: dict, maps: Optional[Dict[str, dict]] = None):
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(key))
+            pipe.hset(self._key(key), mapping={field: encode_field(value) for field, value in record.items()})
+            pipe.expire(self._key(key), self.ttl)
+            for map_name, values in (maps or {}).items():
+                map_key = self._map_key(map_name, key)
+                pipe.delete(map_key)
+                if values:
+                    pipe.hset(map_key, mapping={field: encode_field(value) for field, value in values.items()})
+                    pipe.expire(map_key, self.ttl)
+            pipe.zadd(self.index_key, {key: now})
+            pipe.zremrangebyscore(self.index_key, "-inf", now - self.ttl)
+            pipe.expire(self.index_key, self.ttl)
+            await pipe.execute()
+
+    async def keys(self) -> List[str]:
+        """Keys written within the TTL, oldest first; records evicted early come back as None from get."""
+        members = await self.redis.zrangebyscore(self.index_key, time.time() - self.ttl, "+inf")
+        return [member.decode() for member in members]
+
+STORE_TTL = 24 * 60 * 60
+
+# Full document text is only read on cold paths, so it is stored zstd-compressed;
+# the sentences and word index that every chat request reads stay uncompressed
+TEXT_ZSTD_LEVEL = 3
+text_decompressor = zstd.ZstdDecompressor()
+
+# A document is one record (metadata, text and search index together) so its parts share one expiry;
+# listings read only these fields.
+DOCUMENT_META_FIELDS = ["filename", "upload_time", "word_count", "text_length"]
+EMBEDDING_META_FIELDS = ["method", "chunks_count"]
+
+# Stores live in Redis when REDIS_URL is set, so every worker sees the same data; otherwise in memory.
+redis_url = os.getenv("REDIS_URL")
+if redis_url:
+    import redis.asyncio
+
+    redis_client = redis.asyncio.from_url(redis_url)
+    documents_store = RedisStore(redis_client, "doc", STORE_TTL)
+    embeddings_store = RedisStore(redis_client, "emb", STORE_TTL)
+    workflows_store = RedisStore(redis_client, "workflow", STORE_TTL)
+else:
+    documents_store = MemoryStore(STORE_TTL)
+    embeddings_store = MemoryStore(STORE_TTL)
+    workflows_store = MemoryStore(STORE_TTL)
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Tokenizer shared by the sentence index and query matching
+WORD_RE = re.compile(r"\w+")
+
+# Expand ligatures (e.g. "ﬁ" -> "fi") so extracted text matches plain-ASCII query words
+PDF_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+
+# Limits per embeddings request. The API takes up to 2048 inputs but caps total tokens at 300k.
+# Dense text (CJK, numbers) can approach 2 tokens per char, so batches are sized by characters
+# against that worst case rather than by chunk count alone.
+EMBEDDING_BATCH_SIZE = 128
+EMBEDDING_BATCH_MAX_CHARS = 150_000
+EMBEDDING_MAX_CONCURRENCY = 5
+EMBEDDING_MAX_RETRIES = 3
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_DIM = 1536
+
+class EmbedCache:
+    """Persistent content-addressed cache of embedding vectors, keyed by hash(model, chunk).
+
+    The cache is best-effort: SQLite errors (e.g. the file staying locked by another worker
+    past the timeout) count as misses or skipped writes rather than failing the request.
+    Methods block, so call them from a worker thread.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+        except sqlite3.Error:
+            self.conn = None  # Cache disabled; every lookup is a miss
+
+    @staticmethod
+    def key(model: str, chunk: str) -> bytes:
+        return hashlib.blake2b(model.encode() + b"\0" + chunk.encode(), digest_size=32).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        if self.conn is None:
+            return found
+        try:
+            with self.lock:
+                # Stay well under SQLite's bound-parameter limit
+                for i in range(0, len(keys), 500):
+                    batch = keys[i:i+500]
+                    rows = self.conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                    )
+                    found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+        except sqlite3.Error:
+            pass
+        return found
+
+    def put_many(self, items: Dict[bytes, np.ndarray]):
+        if self.conn is None:
+            return
+        try:
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    ((key, vector.astype(np.float32).tobytes()) for key, vector in items.items())
+                )
+        except sqlite3.Error:
+            pass
+
+embed_cache = EmbedCache(os.getenv("EMBED_CACHE_PATH", "embed_cache.sqlite3"))
+
+# Created on first use by get_openai_client
+openai_client = None
 
 # Data models
 class WorkflowNode(BaseModel):
@@ -56,6 +301,108 @@ class ComponentConfig(BaseModel):
     component_id: str
     config: Dict
 
+def get_openai_client():
+    """Return the shared AsyncOpenAI client, or None without OPENAI_API_KEY.
+
+    Reusing one client keeps its HTTPS connections alive across requests.
+    """
+    global openai_client
+    openai_key = os.getenv("OPENAI_API_KEY")
+    if not openai_key:
+        return None
+    if openai_client is None:
+        import openai
+        openai_client = openai.AsyncOpenAI(api_key=openai_key)
+    return openai_client
+
+def batch_chunks(chunks: List[str]) -> List[List[str]]:
+    """Split chunks, in order, into batches within EMBEDDING_BATCH_SIZE and EMBEDDING_BATCH_MAX_CHARS."""
+    batches, batch, batch_chars = [], [], 0
+    for chunk in chunks:
+        if batch and (len(batch) == EMBEDDING_BATCH_SIZE or batch_chars + len(chunk) > EMBEDDING_BATCH_MAX_CHARS):
+            batches.append(batch)
+            batch, batch_chars = [], 0
+        batch.append(chunk)
+        batch_chars += len(chunk)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    """L2-normalize each row in place, so cosine similarity against them is a plain dot product."""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    embeddings /= norms
+    return embeddings
+
+def quantize_rows(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantize each row to int8 with its own scale, so row i is approximately quantized[i] * scales[i]."""
+    scales = np.abs(embeddings).max(axis=1, keepdims=True) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(embeddings / scales).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+async def embed_chunks(client, chunks: List[str]) -> np.ndarray:
+    """Embed chunks in concurrent batches (bounded in-flight requests) into a (len(chunks), dim) float32 matrix.
+
+    Chunks already in embed_cache are not sent to the API.
+    """
+    semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            response = await client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=batch
+            )
+            return [d.embedding for d in response.data]
+
+    keys = [EmbedCache.key(EMBEDDING_MODEL, chunk) for chunk in chunks]
+    cached = await asyncio.to_thread(embed_cache.get_many, keys)
+    # Identical chunks within a document share a key, so each is sent at most once
+    misses = {key: chunk for key, chunk in zip(keys, chunks) if key not in cached}
+    miss_chunks = list(misses.values())
+
+    batches = batch_chunks(miss_chunks)
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    fresh = {
+        key: np.asarray(embedding, dtype=np.float32)
+        for key, embedding in zip(misses, (embedding for batch in results for embedding in batch))
+    }
+    await asyncio.to_thread(embed_cache.put_many, fresh)
+    cached.update(fresh)
+    if not keys:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    return np.stack([cached[key] for key in keys])
+
+def process_pdf(pdf_path: str) -> Tuple[dict, Dict[str, dict], str]:
+    """Extract and index a PDF, returning its document record fields, search maps and a text preview.
+
+    All of this is blocking work over the full text, so it runs in a worker thread.
+    """
+    with fitz.open(pdf_path) as doc:
+        text = "".join(page.get_text("text", flags=PDF_TEXT_FLAGS) for page in doc)
+
+    # Lowercased sentences are what execute_workflow searches; index them by word once here.
+    # Sentences without words can never match, so they are not kept.
+    sentences = {}
+    postings = defaultdict(list)
+    for i, sentence in enumerate(text.lower().split('.')):
+        words = set(WORD_RE.findall(sentence))
+        if words:
+            sentences[str(i)] = sentence
+        for word in words:
+            postings[word].append(i)
+
+    record = {
+        "word_count": len(text.split()),
+        "text_length": len(text),
+        # Compressor objects are not thread-safe, so each call uses its own
+        "text_zstd": zstd.ZstdCompressor(level=TEXT_ZSTD_LEVEL).compress(text.encode())
+    }
+    preview = text[:500] + "..." if len(text) > 500 else text
+    return record, {"sentences": sentences, "postings": dict(postings)}, preview
+
 @app.get("/")
 async def root():
     return {"message": "Workflow Builder API is running"}
@@ -66,62 +413,64 @@ async def upload_document(file: UploadFile = File(...)):
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are supported")
 
-        content = await file.read()
-        doc = fitz.open(stream=content, filetype="pdf")
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
+        # Stream the upload to disk so PyMuPDF reads it from a file instead of one in-memory buffer
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path = os.path.join(tmp_dir, "upload.pdf")
+            async with aiofiles.open(pdf_path, "wb") as out:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    await out.write(chunk)
+
+            # Parsing and indexing are blocking; run them off the event loop so other requests keep being served
+            try:
+                record, maps, preview = await asyncio.get_running_loop().run_in_executor(None, process_pdf, pdf_path)
+            except fitz.FileDataError:
+                # The message names the server-side temp path, so don't pass it on
+                raise HTTPException(status_code=400, detail="Invalid or corrupt PDF file")
 
-        doc_id = f"doc_{int(time.time())}"
-        documents_store[doc_id] = {
+        doc_id = f"doc_{uuid.uuid4().hex}"
+        await documents_store.set(doc_id, {
             "filename": file.filename,
-            "text": text,
             "upload_time": time.time(),
-            "word_count": len(text.split())
-        }
+            **record
+        }, maps=maps)
 
         return {
             "document_id": doc_id,
             "filename": file.filename,
-            "text_length": len(text),
-            "word_count": len(text.split()),
-            "preview": text[:500] + "..." if len(text) > 500 else text
+            "text_length": record["text_length"],
+            "word_count": record["word_count"],
+            "preview": preview
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing document: {str(e)}")
 
 @app.post("/generate-embeddings/{doc_id}")
 async def generate_embeddings(doc_id: str):
-    if doc_id not in documents_store:
+    document = await documents_store.get(doc_id, ["text_zstd"])
+    if document is None:
         raise HTTPException(status_code=404, detail="Document not found")
 
     try:
-        document = documents_store[doc_id]
-        text = document["text"]
-        openai_key = os.getenv("OPENAI_API_KEY")
+        text = text_decompressor.decompress(document["text_zstd"]).decode()
+        client = get_openai_client()
 
-        if openai_key:
+        if client:
             try:
-                import openai
-                openai.api_key = openai_key
-
                 chunks = [text[i:i+8000] for i in range(0, len(text), 8000)]
-                embeddings = []
-
-                for chunk in chunks:
-                    response = openai.Embedding.create(
-                        model="text-embedding-ada-002",
-                        input=chunk
-                    )
-                    embeddings.append(response.data[0].embedding)
-
-                embeddings_store[doc_id] = {
-                    "embeddings": embeddings,
-                    "chunks": chunks,
+                # The SDK retries 429s (honouring Retry-After), connection errors and 5xx with jittered backoff
+                embeddings = await embed_chunks(client.with_options(max_retries=EMBEDDING_MAX_RETRIES), chunks)
+
+                quantized, scales = quantize_rows(normalize_rows(embeddings))
+                await embeddings_store.set(doc_id, {
+                    "embeddings_int8": quantized,
+                    "scales": scales,
+                    "chunk_size": 8000,
+                    "chunks_count": len(chunks),
                     "method": "openai"
-                }
+                })
 
                 return {
                     "document_id": doc_id,
@@ -135,13 +484,16 @@ async def generate_embeddings(doc_id: str):
 
         # Mock embeddings
         chunks = [text[i:i+1000] for i in range(0, len(text), 1000)]
-        mock_embeddings = [[random.random() for _ in range(1536)] for _ in chunks]
-
-        embeddings_store[doc_id] = {
-            "embeddings": mock_embeddings,
-            "chunks": chunks,
+        mock_embeddings = np.random.default_rng().random((len(chunks), EMBEDDING_DIM), dtype=np.float32)
+        quantized, scales = quantize_rows(normalize_rows(mock_embeddings))
+
+        await embeddings_store.set(doc_id, {
+            "embeddings_int8": quantized,
+            "scales": scales,
+            "chunk_size": 1000,
+            "chunks_count": len(chunks),
             "method": "mock"
-        }
+        })
 
         return {
             "document_id": doc_id,
@@ -155,12 +507,8 @@ async def generate_embeddings(doc_id: str):
 
 @app.post("/save-workflow")
 async def save_workflow(workflow: WorkflowData):
-    workflow_id = f"workflow_{int(time.time())}"
-    workflows_store[workflow_id] = {
-        "nodes": [node.dict() for node in workflow.nodes],
-        "edges": [edge.dict() for edge in workflow.edges],
-        "created_at": time.time()
-    }
+    workflow_id = f"workflow_{uuid.uuid4().hex}"
+    await workflows_store.set(workflow_id, workflow.model_dump() | {"created_at": time.time()})
     return {"workflow_id": workflow_id, "message": "Workflow saved successfully"}
 
 @app.post("/execute-workflow")
@@ -168,29 +516,38 @@ async def execute_workflow(chat_data: ChatMessage):
     try:
         user_query = chat_data.message
 
-        if not documents_store:
+        # Newest document that is still stored (Redis may evict a record before its TTL)
+        doc_id = document = None
+        for candidate_id in reversed(await documents_store.keys()):
+            document = await documents_store.get(candidate_id, ["filename"])
+            if document is not None:
+                doc_id = candidate_id
+                break
+
+        if document is None:
             return {
                 "response": "No documents have been uploaded yet. Please upload a PDF document first to enable knowledge-based responses."
             }
 
-        latest_doc_id = max(documents_store.keys(), key=lambda x: documents_store[x]["upload_time"])
-        document = documents_store[latest_doc_id]
-
-        doc_text = document["text"].lower()
-        query_lower = user_query.lower()
-        sentences = doc_text.split('.')
-        relevant_sentences = [s.strip() for s in sentences if any(word in s.lower() for word in query_lower.split())]
+        # Fetch only the postings for the query's words and the sentences they point to
+        query_words = list(dict.fromkeys(WORD_RE.findall(user_query.lower())))
+        postings = await documents_store.get_map_values(doc_id, "postings", query_words)
+        matches = set().union(*(ids for ids in postings if ids))
+        sentence_ids = [str(i) for i in heapq.nsmallest(3, matches)]
+        sentences = await documents_store.get_map_values(doc_id, "sentences", sentence_ids)
+        relevant_sentences = [sentence.strip() for sentence in sentences if sentence is not None]
 
-        context = '. '.join(relevant_sentences[:3]) if relevant_sentences else document["text"][:500]
+        if relevant_sentences:
+            context = '. '.join(relevant_sentences)
+        else:
+            fallback = await documents_store.get(doc_id, ["text_zstd"])
+            context = text_decompressor.decompress(fallback["text_zstd"]).decode()[:500] if fallback else ""
 
-        openai_key = os.getenv("OPENAI_API_KEY")
+        client = get_openai_client()
 
-        if openai_key:
+        if client:
             try:
-                import openai
-                openai.api_key = openai_key
-
-                response = openai.ChatCompletion.create(
+                response = await client.chat.completions.create(
                     model="gpt-3.5-turbo",
                     messages=[
                         {"role": "system", "content": f"You are a helpful assistant. Use the following context to answer the user's question: {context}"},
@@ -230,11 +587,23 @@ async def execute_workflow(chat_data: ChatMessage):
 
 @app.get("/documents")
 async def get_documents():
-    return {"documents": documents_store}
+    doc_ids = await documents_store.keys()
+    records = await documents_store.get_many(doc_ids, DOCUMENT_META_FIELDS)
+    return {"documents": {doc_id: record for doc_id, record in zip(doc_ids, records) if record is not None}}
+
+@app.get("/documents/{doc_id}/text")
+async def get_document_text(doc_id: str):
+    document = await documents_store.get(doc_id, ["text_zstd"])
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    return {"document_id": doc_id, "text": text_decompressor.decompress(document["text_zstd"]).decode()}
 
 @app.get("/embeddings")
 async def get_embeddings():
-    return {"embeddings": {k: {"method": v["method"], "chunks_count": len(v["chunks"])} for k, v in embeddings_store.items()}}
+    doc_ids = await embeddings_store.keys()
+    records = await embeddings_store.get_many(doc_ids, EMBEDDING_META_FIELDS)
+    return {"embeddings": {doc_id: record for doc_id, record in zip(doc_ids, records) if record is not None}}
 
 if __name__ == "__main__":
     import uvicorn